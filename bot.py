@@ -1,36 +1,88 @@
 import logging
-import io
-import requests
+import hashlib
+import aiohttp
 import asyncio
+import contextlib
 import os
+import tempfile
+import threading
+import time
+from cachetools import LRUCache, TLRUCache
+
+import removebg
 
 # Changed import: ChatAction is now in telegram.constants for python-telegram-bot v21+
 from telegram import Update, InputFile, ReplyKeyboardMarkup, KeyboardButton
 from telegram.constants import ChatAction # <-- Updated import path for ChatAction
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     filters,
     ContextTypes,
 )
-from asyncio import sleep, CancelledError # Explicitly import sleep and CancelledError
 
 # --- Configuration ---
 # Get sensitive keys from environment variables for better security and deployment
+# REMOVE_BG_API_KEY is read and checked in removebg.py
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
-REMOVE_BG_API_KEY = os.environ.get("REMOVE_BG_API_KEY")
 
 # Basic check if environment variables are set
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN environment variable not set. Please set it.")
-if not REMOVE_BG_API_KEY:
-    raise ValueError("REMOVE_BG_API_KEY environment variable not set. Please set it.")
 
-REMOVE_BG_API_URL = "https://api.remove.bg/v1.0/removebg"
+# --- Result Cache ---
+# Processed PNGs are kept on disk keyed by a hash of the uploaded image, so a resent picture skips remove.bg
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "cache")
+# Total size of the PNGs kept on disk; past it the least recently used ones are deleted down to 90% of the limit
+RESULT_DISK_CACHE_BYTES = 1024 * 1024 * 1024
+# Upper bound on remembered Telegram file_unique_id -> content hash entries, so the map can't grow forever
+IMAGE_HASH_CACHE_SIZE = 10_000
+# Upper bound on remembered content hash -> Telegram file_id of the result document already sent for it
+RESULT_FILE_ID_CACHE_SIZE = 10_000
+# Total size of processed PNGs also kept in memory (most recently used first), in front of the disk cache
+RESULT_MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+
+# --- Minimum Image Size ---
+# Icons and thumbnails below these limits aren't worth a remove.bg call
+MIN_IMAGE_PIXELS = 10_000
+MIN_IMAGE_FILE_SIZE = 5_000 # bytes
+
+# --- Photo Worker Pool ---
+# Photos are processed by a fixed number of workers fed from a bounded queue; when the queue is full
+# new photos are turned away with a "busy" reply instead of piling up in memory
+PHOTO_WORKERS = 16
+PHOTO_QUEUE_SIZE = 200
+# On shutdown, queued and in-flight photos get this long (seconds) to finish before the workers are cancelled
+PHOTO_DRAIN_TIMEOUT = 30
+
+# --- Progress Edit Throttling ---
+# Progress edits to the same chat are spaced at least this far apart (seconds), matching Telegram's per-chat limit
+MIN_EDIT_INTERVAL = 1.0
+# Longest a progress edit may wait on the chat's throttle or on 429 retries before it's given up, in seconds
+MAX_EDIT_WAIT = 5.0
+# Longest a purely cosmetic chat action ("sending photo...") may hold up processing, in seconds
+CHAT_ACTION_TIMEOUT = 1.0
 
 # --- Constants for Reply Keyboard ---
 BTN_REMOVE_BACKGROUND = "🖼️ Remove Background"
+# --- Reply Texts ---
+# Fixed texts are built once at import instead of on every command
+START_TEXT = (
+    "Hello! I'm your Background Remover Bot.\n"
+    f"Tap the '{BTN_REMOVE_BACKGROUND}' button to begin."
+)
+HELP_TEXT = (
+    "How to use me:\n"
+    f"1. Tap the '{BTN_REMOVE_BACKGROUND}' button below.\n"
+    "2. Then, send me the image you want to process.\n"
+    "3. I will send back the version with the background removed as a PNG.\n\n"
+    "Powered by remove.bg"
+)
+PHOTO_QUEUE_FULL_TEXT = "I'm busy with a lot of images right now. Please send yours again in a moment."
+RESULT_CAPTION = "Here's your image with the background removed (PNG format)!"
 # --- State Management Key ---
 STATE_WAITING_FOR_IMAGE = 'waiting_for_image'
 
@@ -42,51 +94,227 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def get_main_keyboard():
-    keyboard = [[KeyboardButton(BTN_REMOVE_BACKGROUND)]]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+# The keyboard never changes, so build it once instead of on every reply
+MAIN_KEYBOARD = ReplyKeyboardMarkup([[KeyboardButton(BTN_REMOVE_BACKGROUND)]], resize_keyboard=True, one_time_keyboard=False)
+
+# --- Message Filters ---
+# Built once here and reused by the handler registration in main()
+REMOVE_BG_BUTTON_FILTER = filters.Text([BTN_REMOVE_BACKGROUND])
+OTHER_TEXT_FILTER = filters.TEXT & ~filters.COMMAND
+# Anything that isn't text, a photo or a command (stickers, documents, voice notes...)
+OTHER_MESSAGE_FILTER = ~(filters.TEXT | filters.PHOTO | filters.COMMAND)
 
-# --- Helper function for continuously sending chat action ---
-async def send_chat_action_periodically(chat_id: int, context: ContextTypes.DEFAULT_TYPE, action_type: ChatAction, interval: int = 4):
-    """Sends a chat action repeatedly until cancelled."""
+# --- Helper function for sending a chat action ---
+async def send_chat_action(context: ContextTypes.DEFAULT_TYPE, chat_id: int, action: ChatAction):
+    """Sends a one-off chat action; it's only cosmetic, so a slow or failed call never holds up the real work."""
     try:
-        while True:
-            await context.bot.send_chat_action(chat_id=chat_id, action=action_type)
-            await sleep(interval)
-    except CancelledError:
-        logger.info(f"Chat action {action_type} for chat {chat_id} was cancelled.")
-    except Exception as e:
-        logger.error(f"Error in send_chat_action_periodically for chat {chat_id}: {e}", exc_info=True)
+        await asyncio.wait_for(context.bot.send_chat_action(chat_id=chat_id, action=action), timeout=CHAT_ACTION_TIMEOUT)
+    except (TelegramError, asyncio.TimeoutError) as e:
+        logger.warning("Failed to send chat action %s to chat %d: %r", action, chat_id, e)
+
+# --- Helper function for updating the progress message ---
+# chat_id -> earliest time.monotonic() at which another progress edit may be sent to that chat;
+# each entry expires exactly at its own deadline, however long a 429's retry_after was
+_next_edit_allowed_at = TLRUCache(maxsize=10_000, ttu=lambda chat_id, deadline, now: deadline, timer=time.monotonic)
+
+async def edit_progress_message(progress_msg, text: str, user_id: int):
+    """Edits the progress message, returning the edited message, or None if the edit failed or was given up on.
+
+    While the chat is throttled, including for the retry_after window of a 429, the edit waits its turn,
+    but only for up to MAX_EDIT_WAIT in total, so a chat under flood control can't hold the caller for long.
+    """
+    if not progress_msg:
+        return None
+    if progress_msg.text == text:
+        return progress_msg # Telegram rejects edits that don't change anything, so skip the round-trip
+    chat_id = progress_msg.chat_id
+    give_up_at = time.monotonic() + MAX_EDIT_WAIT
+    while True:
+        now = time.monotonic()
+        delay = _next_edit_allowed_at.get(chat_id, 0) - now
+        if now + delay > give_up_at:
+            logger.warning("Giving up progress edit for user %d: chat %d is throttled for another %.1fs.", user_id, chat_id, delay)
+            return None
+        if delay > 0:
+            logger.info("Delaying progress edit for user %d by %.1fs: chat %d is throttled.", user_id, delay, chat_id)
+            await asyncio.sleep(delay)
+            continue # Another edit to the chat may have taken the slot meanwhile
+        # Claim the slot before awaiting, so concurrent edits to the same chat queue up behind this one
+        _next_edit_allowed_at[chat_id] = time.monotonic() + MIN_EDIT_INTERVAL
+        try:
+            return await progress_msg.edit_text(text)
+        except RetryAfter as e:
+            logger.warning("Progress edits for chat %d rate limited, retrying in %ss.", chat_id, e.retry_after)
+            _next_edit_allowed_at[chat_id] = time.monotonic() + e.retry_after
+        except TelegramError as e:
+            if isinstance(e, BadRequest) and "message is not modified" in e.message.lower():
+                return progress_msg
+            logger.warning("Failed to edit progress message for user %d: %s", user_id, e)
+            return None
+
+def finish_progress_message(context: ContextTypes.DEFAULT_TYPE, progress_msg, user_id: int):
+    """Marks the progress message completed in the background; the result is already delivered, so no worker waits on it."""
+    edit_task = asyncio.create_task(edit_progress_message(progress_msg, "✅ Processing Completed!", user_id))
+    progress_edits = context.bot_data['progress_edits']
+    progress_edits.add(edit_task) # Keeps a reference until it's done, and lets shutdown wait for it
+    edit_task.add_done_callback(progress_edits.discard)
+
+async def report_to_user(message, progress_msg, text: str, user_id: int):
+    """Shows text in the progress message if there is one, falling back to a fresh reply with the keyboard."""
+    # Goes through the per-chat throttle like every other progress edit; edits can't carry a reply keyboard
+    if await edit_progress_message(progress_msg, text, user_id):
+        return
+    try:
+        await message.reply_text(text, reply_markup=MAIN_KEYBOARD)
+    except TelegramError as e: # e.g. RetryAfter while the chat is under flood control
+        logger.error("Failed to report to user %d: %s", user_id, e)
+
+# --- Helper functions for the on-disk result cache ---
+def get_cache_key(image_bytes) -> str:
+    """Content hash used to name cached results; blake2b is faster than md5/sha for this job."""
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+# Running total of the PNGs in RESULT_CACHE_DIR, counted by the first write; writes run on worker threads
+_disk_cache_bytes = None
+_disk_cache_lock = threading.Lock()
+
+def read_cached_result(cache_key: str):
+    """Returns the cached PNG bytes for cache_key, or None if the image hasn't been processed before."""
+    cache_path = os.path.join(RESULT_CACHE_DIR, f"{cache_key}.png")
+    try:
+        with open(cache_path, 'rb') as cached_file:
+            image_bytes = cached_file.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning("Failed to read cached result %s: %s", cache_key, e)
+        return None
+    with contextlib.suppress(OSError):
+        os.utime(cache_path) # A hit counts as a use, so pruning keeps the popular results
+    return image_bytes
+
+def write_cached_result(cache_key: str, image_bytes: bytes):
+    """Stores a processed PNG, writing to a temp file first so readers never see a partial image."""
+    global _disk_cache_bytes
+    cache_path = os.path.join(RESULT_CACHE_DIR, f"{cache_key}.png")
+    temp_path = None
+    try:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        # Each write gets its own temp file, as several workers may store the same image at once
+        temp_fd, temp_path = tempfile.mkstemp(dir=RESULT_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(temp_fd, 'wb') as cached_file:
+            cached_file.write(image_bytes)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        logger.warning("Failed to write cached result %s: %s", cache_key, e)
+        if temp_path:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+        return
+    # The total is only an estimate (a rewritten key is counted twice) and is recounted whenever pruning runs
+    with _disk_cache_lock:
+        if _disk_cache_bytes is None or _disk_cache_bytes + len(image_bytes) > RESULT_DISK_CACHE_BYTES:
+            _disk_cache_bytes = prune_result_cache()
+        else:
+            _disk_cache_bytes += len(image_bytes)
+
+def prune_result_cache() -> int:
+    """Deletes the least recently used PNGs while the disk cache is over its limit, returning its new total size."""
+    cached_files = []
+    try:
+        with os.scandir(RESULT_CACHE_DIR) as entries:
+            for entry in entries:
+                if entry.name.endswith('.png'):
+                    with contextlib.suppress(OSError): # Another thread may have just removed it
+                        stat = entry.stat()
+                        cached_files.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError as e:
+        logger.warning("Failed to scan the result cache: %s", e)
+        return 0
+    total_bytes = sum(size for _, size, _ in cached_files)
+    if total_bytes <= RESULT_DISK_CACHE_BYTES:
+        return total_bytes
+    removed = 0
+    for _, size, path in sorted(cached_files): # Oldest first
+        if total_bytes <= RESULT_DISK_CACHE_BYTES * 0.9:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Failed to remove cached result %s: %s", path, e)
+            continue
+        total_bytes -= size
+        removed += 1
+    logger.info("Pruned %d cached results, the disk cache now holds %d bytes.", removed, total_bytes)
+    return total_bytes
+
+async def load_cached_result(context: ContextTypes.DEFAULT_TYPE, cache_key: str):
+    """Returns the cached PNG for cache_key from memory, falling back to disk, or None on a miss."""
+    result_bytes = context.bot_data['result_bytes']
+    image_bytes = result_bytes.get(cache_key)
+    if image_bytes is None:
+        image_bytes = await asyncio.to_thread(read_cached_result, cache_key)
+        if image_bytes is not None:
+            remember_result_bytes(result_bytes, cache_key, image_bytes)
+    return image_bytes
+
+async def store_cached_result(context: ContextTypes.DEFAULT_TYPE, cache_key: str, image_bytes: bytes):
+    """Keeps a processed PNG in memory and on disk."""
+    remember_result_bytes(context.bot_data['result_bytes'], cache_key, image_bytes)
+    await asyncio.to_thread(write_cached_result, cache_key, image_bytes)
+
+def remember_result_bytes(result_bytes: LRUCache, cache_key: str, image_bytes: bytes):
+    """Adds a result to the in-memory cache; one bigger than the whole cache stays on disk only."""
+    if len(image_bytes) <= result_bytes.maxsize:
+        result_bytes[cache_key] = image_bytes
+
+async def send_cached_result(context: ContextTypes.DEFAULT_TYPE, chat_id: int, cache_key: str, user_id: int) -> bool:
+    """Re-sends a result Telegram already stores by its file_id, so no bytes are uploaded. Returns False on a miss."""
+    result_file_ids = context.bot_data['result_file_ids']
+    cached_file_id = result_file_ids.get(cache_key)
+    if not cached_file_id:
+        return False
+    try:
+        await context.bot.send_document(
+            chat_id=chat_id,
+            document=cached_file_id,
+            caption=RESULT_CAPTION,
+            reply_markup=MAIN_KEYBOARD
+        )
+    except TelegramError as e:
+        logger.warning("Failed to re-send cached result %s for user %d, processing again: %s", cache_key, user_id, e)
+        result_file_ids.pop(cache_key, None)
+        return False
+    logger.info("Re-sent cached result %s for user %d by file_id, skipping remove.bg.", cache_key, user_id)
+    return True
+
+# --- Helper function for per-user state ---
+def reset_user_state(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Clears the waiting state and drops the user's user_data once empty, so idle users don't accumulate in memory."""
+    context.user_data.pop(STATE_WAITING_FOR_IMAGE, None)
+    if not context.user_data:
+        context.application.drop_user_data(user_id)
 
 
 # --- Bot Command Handlers ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Clear state on start to ensure a fresh interaction
-    context.user_data.pop(STATE_WAITING_FOR_IMAGE, None) 
-    await update.message.reply_text(
-        "Hello! I'm your Background Remover Bot.\n"
-        f"Tap the '{BTN_REMOVE_BACKGROUND}' button to begin.",
-        reply_markup=get_main_keyboard()
-    )
+    reset_user_state(context, update.effective_user.id)
+    await update.message.reply_text(START_TEXT, reply_markup=MAIN_KEYBOARD)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Clear state on help
-    context.user_data.pop(STATE_WAITING_FOR_IMAGE, None) 
-    await update.message.reply_text(
-        "How to use me:\n"
-        f"1. Tap the '{BTN_REMOVE_BACKGROUND}' button below.\n"
-        "2. Then, send me the image you want to process.\n"
-        "3. I will send back the version with the background removed as a PNG.\n\n"
-        "Powered by remove.bg",
-        reply_markup=get_main_keyboard()
-    )
+    reset_user_state(context, update.effective_user.id)
+    await update.message.reply_text(HELP_TEXT, reply_markup=MAIN_KEYBOARD)
 
 async def handle_remove_bg_button_press(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data[STATE_WAITING_FOR_IMAGE] = True
-    logger.info(f"User {update.effective_user.id} pressed '{BTN_REMOVE_BACKGROUND}'. State set to WAITING_FOR_IMAGE.")
+    logger.info("User %d pressed '%s'. State set to WAITING_FOR_IMAGE.", update.effective_user.id, BTN_REMOVE_BACKGROUND)
     await update.message.reply_text(
         "Okay, please send me the image you want to process now.",
-        reply_markup=get_main_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -94,174 +322,230 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
     if context.user_data.get(STATE_WAITING_FOR_IMAGE) is True:
-        logger.info(f"User {user_id} sent a photo while in WAITING_FOR_IMAGE state. Processing...")
-
-        # Initialize progress_msg to None
-        progress_msg = None
-        # Start a background task to send 'upload_photo' chat action periodically
-        # This will show the user that the bot is actively processing/uploading
-        chat_action_task = asyncio.create_task(
-            send_chat_action_periodically(message.chat_id, context, ChatAction.UPLOAD_PHOTO)
-        )
+        logger.info("User %d sent a photo while in WAITING_FOR_IMAGE state. Queueing it for processing...", user_id)
+        photo = message.photo[-1] # Get the largest available photo from Telegram
+
+        # Telegram already reports the photo's size, so tiny images are turned away before any download or API call
+        if photo.width * photo.height < MIN_IMAGE_PIXELS or (photo.file_size and photo.file_size < MIN_IMAGE_FILE_SIZE):
+            logger.info("User %d sent a %dx%d photo (%s bytes), below the minimum size.", user_id, photo.width, photo.height, photo.file_size)
+            await message.reply_text(
+                "This image is too small to process. Please send a larger image.",
+                reply_markup=MAIN_KEYBOARD
+            )
+            return # Still waiting, so the user can send a bigger image straight away
 
+        photo_queue = context.bot_data['photo_queue']
+        if photo_queue.full():
+            logger.warning("Photo queue is full, turning away a photo from user %d.", user_id)
+            await message.reply_text(PHOTO_QUEUE_FULL_TEXT, reply_markup=MAIN_KEYBOARD)
+            return # Still waiting, so the user can simply resend
+
+        # Acknowledge the photo straight away, as it may wait in the queue before a worker picks it up;
+        # the worker later edits this message with the outcome
+        try:
+            progress_msg = await message.reply_text("✨ Processing your image...", reply_markup=MAIN_KEYBOARD)
+        except Exception as e:
+            logger.error("Failed to send initial progress message to user %d: %s", user_id, e, exc_info=True)
+            await message.reply_text("Sorry, I couldn't send the initial progress message. Please try again.", reply_markup=MAIN_KEYBOARD)
+            return
+
+        # The heavy work runs on the photo workers; the handler only queues it so other updates keep flowing
         try:
-            # Send initial message, which will be updated later
-            try:
-                progress_msg = await message.reply_text(
-                    "✨ Starting image processing...",
-                    reply_markup=get_main_keyboard()
-                )
-            except Exception as e:
-                logger.error(f"Failed to send initial progress message to user {user_id}: {e}", exc_info=True)
-                await message.reply_text("Sorry, I couldn't send the initial progress message. Please try again.", reply_markup=get_main_keyboard())
-                context.user_data[STATE_WAITING_FOR_IMAGE] = False
-                return # Exit if initial message fails
-
-            # --- Actual Image Processing Logic ---
-            photo_file_id = message.photo[-1].file_id # Get the largest available photo from Telegram
-            
-            # Update message to indicate image download
-            if progress_msg:
-                try:
-                    await progress_msg.edit_text("⬇️ Downloading your image...", reply_markup=get_main_keyboard())
-                except Exception as e:
-                    logger.warning(f"Failed to edit progress message for user {user_id} during download text update: {e}")
-                    progress_msg = None # Stop trying to edit if it failed once
-
-            photo_file_obj = await context.bot.get_file(photo_file_id)
+            photo_queue.put_nowait((update, context, progress_msg))
+        except asyncio.QueueFull: # Filled up while the progress message was being sent
+            logger.warning("Photo queue is full, turning away a photo from user %d.", user_id)
+            await report_to_user(message, progress_msg, PHOTO_QUEUE_FULL_TEXT, user_id)
+            return # Still waiting, so the user can simply resend
+        reset_user_state(context, user_id)
+        logger.info("User %d state reset from WAITING_FOR_IMAGE.", user_id)
+    else:
+        logger.info("User %d sent a photo but was NOT in WAITING_FOR_IMAGE state.", user_id)
+        reset_user_state(context, user_id)
+        await message.reply_text(
+            f"Please tap the '{BTN_REMOVE_BACKGROUND}' button first before sending an image.",
+            reply_markup=MAIN_KEYBOARD
+        )
+
+async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, progress_msg):
+    """Removes the background from a queued photo and sends the result; run by the photo workers."""
+    message = update.message
+    user_id = update.effective_user.id
+    photo = message.photo[-1] # Get the largest available photo from Telegram
+
+    try:
+        # --- Actual Image Processing Logic ---
+        output_filename = 'bg_removed.png'
+
+        # Look up an earlier result for this Telegram file before downloading anything
+        image_hashes = context.bot_data['image_hashes']
+        cache_key = image_hashes.get(photo.file_unique_id)
+        if cache_key and await send_cached_result(context, message.chat_id, cache_key, user_id):
+            finish_progress_message(context, progress_msg, user_id)
+            return
+        processed_image_bytes = await load_cached_result(context, cache_key) if cache_key else None
+
+        if processed_image_bytes is None:
+            photo_file_obj = await context.bot.get_file(photo.file_id)
+            # The bytearray is hashed and uploaded as-is, without wrapping it in another buffer
             image_byte_array = await photo_file_obj.download_as_bytearray()
-            image_bytes_io = io.BytesIO(image_byte_array)
             original_filename = photo_file_obj.file_path.split('/')[-1] if photo_file_obj.file_path else 'input_image.jpg'
-            image_bytes_io.name = original_filename
-
-            logger.info(f"Downloaded image for processing: {original_filename}, size: {len(image_byte_array)} bytes.")
-
-            # Update message to indicate sending to API
-            if progress_msg:
-                try:
-                    await progress_msg.edit_text("🚀 Sending image to remove.bg API...", reply_markup=get_main_keyboard())
-                except Exception as e:
-                    logger.warning(f"Failed to edit progress message for user {user_id} during API send text update: {e}")
-                    progress_msg = None
-
-            headers = {'X-Api-Key': REMOVE_BG_API_KEY}
-            data_payload = {
-                'format': 'png',
-                'size': 'auto',
-            }
-            files_payload = {'image_file': image_bytes_io}
-            
-            logger.info(f"Sending image to remove.bg API with payload: {data_payload}")
-            response = requests.post(REMOVE_BG_API_URL, headers=headers, files=files_payload, data=data_payload, timeout=45) # Increased timeout slightly
-            response.raise_for_status() # Raises HTTPError for bad responses (4xx or 5xx)
-            processed_image_bytes = response.content
-            
-            output_filename = 'bg_removed.png'
-            content_type_header = response.headers.get('Content-Type', '').lower()
+
+            logger.info("Downloaded image for processing: %s, size: %d bytes.", original_filename, len(image_byte_array))
+            cache_key = get_cache_key(image_byte_array)
+            image_hashes[photo.file_unique_id] = cache_key
+            # The same picture may have been processed before under a different Telegram file
+            if await send_cached_result(context, message.chat_id, cache_key, user_id):
+                finish_progress_message(context, progress_msg, user_id)
+                return
+            processed_image_bytes = await load_cached_result(context, cache_key)
+
+        if processed_image_bytes is not None:
+            logger.info("Reusing cached result %s for user %d, skipping remove.bg.", cache_key, user_id)
+        else:
+            # A chat action shows on the client for ~5s, so one per stage is enough instead of a polling loop
+            await send_chat_action(context, message.chat_id, ChatAction.UPLOAD_PHOTO)
+            processed_image_bytes, content_type_header = await removebg.remove_background(
+                image_byte_array, original_filename, size=removebg.output_size_for(photo.width, photo.height)
+            )
 
             if 'image/png' not in content_type_header:
-                logger.warning(f"remove.bg did NOT return a PNG as expected. Content-Type: {content_type_header}. This might be an error image or wrong format.")
+                logger.warning("remove.bg did NOT return a PNG as expected. Content-Type: %s. This might be an error image or wrong format.", content_type_header)
                 if "image/" in content_type_header:
                     extension = content_type_header.split('/')[-1]
                     output_filename = f'bg_removed_output.{extension}'
                 else: # Definitely not an image, likely an error from API despite status 200
-                    error_text_from_api = processed_image_bytes.decode('utf-8', errors='ignore')[:500]
-                    logger.error(f"remove.bg returned non-image content: {error_text_from_api}")
-                    await (progress_msg.edit_text if progress_msg else message.reply_text)(
+                    error_text_from_api = processed_image_bytes[:500].decode('utf-8', errors='ignore')
+                    logger.error("remove.bg returned non-image content: %s", error_text_from_api)
+                    await report_to_user(
+                        message, progress_msg,
                         f"Sorry, remove.bg returned an unexpected response. It might be an error: {error_text_from_api}",
-                        reply_markup=get_main_keyboard()
+                        user_id
                     )
-                    context.user_data[STATE_WAITING_FOR_IMAGE] = False
                     return
+            else:
+                await store_cached_result(context, cache_key, processed_image_bytes)
 
-            logger.info(f"Received processed image from remove.bg, size: {len(processed_image_bytes)} bytes. Content-Type: {content_type_header}")
-
-            # Final update before sending the image
-            if progress_msg:
-                try:
-                    await progress_msg.edit_text("✅ Processing Completed!\n📤 Sending your result...", reply_markup=get_main_keyboard())
-                except Exception as e:
-                    logger.warning(f"Failed to edit progress message for user {user_id} during completion step: {e}")
-                    progress_msg = None
-            
-            await context.bot.send_document(
-                chat_id=message.chat_id,
-                document=InputFile(io.BytesIO(processed_image_bytes), filename=output_filename),
-                caption="Here's your image with the background removed (PNG format)!",
-                reply_markup=get_main_keyboard()
-            )
+            logger.info("Received processed image from remove.bg, size: %d bytes. Content-Type: %s", len(processed_image_bytes), content_type_header)
 
-        except requests.exceptions.HTTPError as e:
-            error_message_text = f"❌ API Error ({e.response.status_code}): "
-            try:
-                error_details_json = e.response.json()
-                errors = error_details_json.get('errors', [])
-                if errors and isinstance(errors, list) and len(errors) > 0 and 'title' in errors[0]:
-                    error_message_text += errors[0]['title']
-                    if 'detail' in errors[0]: error_message_text += f" - {errors[0]['detail']}"
-                else:
-                    error_message_text += e.response.text[:200]
-            except ValueError:
-                error_message_text += e.response.text[:200]
-            logger.error(f"HTTP error from remove.bg: {error_message_text} | Full response text: {e.response.text}")
-            await (progress_msg.edit_text if progress_msg else message.reply_text)(error_message_text, reply_markup=get_main_keyboard())
-
-        except requests.exceptions.Timeout:
-            logger.error("Request to remove.bg API timed out.")
-            await (progress_msg.edit_text if progress_msg else message.reply_text)("⏳ The background removal service timed out. Please try again.", reply_markup=get_main_keyboard())
-
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Request error connecting to remove.bg: {e}")
-            await (progress_msg.edit_text if progress_msg else message.reply_text)("🚫 Could not connect to the background removal service. Please check your internet or try again later.", reply_markup=get_main_keyboard())
+        await send_chat_action(context, message.chat_id, ChatAction.UPLOAD_DOCUMENT)
+        sent_message = await context.bot.send_document(
+            chat_id=message.chat_id,
+            document=InputFile(processed_image_bytes, filename=output_filename),
+            caption=RESULT_CAPTION,
+            reply_markup=MAIN_KEYBOARD
+        )
+        context.bot_data['result_file_ids'][cache_key] = sent_message.document.file_id
+        # The only progress edit, made in the background once the result is already delivered
+        finish_progress_message(context, progress_msg, user_id)
+
+    except aiohttp.ClientResponseError as e:
+        error_message_text = f"❌ API Error ({e.status}): {e.message}"
+        logger.error("HTTP error from remove.bg: %s", error_message_text)
+        await report_to_user(message, progress_msg, error_message_text, user_id)
+
+    except asyncio.TimeoutError:
+        logger.error("Request to remove.bg API timed out.")
+        await report_to_user(message, progress_msg, "⏳ The background removal service timed out. Please try again.", user_id)
+
+    except aiohttp.ClientError as e:
+        logger.error("Request error connecting to remove.bg: %s", e)
+        await report_to_user(message, progress_msg, "🚫 Could not connect to the background removal service. Please check your internet or try again later.", user_id)
         
+    except Exception as e:
+        logger.error("An unexpected error occurred during image processing: %s", e, exc_info=True)
+        await report_to_user(message, progress_msg, "❓ An unexpected error occurred while processing your image. Please try again.", user_id)
+
+async def photo_worker(queue: asyncio.Queue, photo_jobs: dict):
+    """Processes queued photos one at a time; PHOTO_WORKERS of these run side by side.
+
+    While busy, the worker's task maps to its (update, progress_msg) in photo_jobs, so shutdown can tell that user.
+    """
+    worker = asyncio.current_task()
+    while True:
+        update, context, progress_msg = await queue.get()
+        photo_jobs[worker] = (update, progress_msg)
+        try:
+            await process_photo(update, context, progress_msg)
         except Exception as e:
-            logger.error(f"An unexpected error occurred during image processing: {e}", exc_info=True)
-            await (progress_msg.edit_text if progress_msg else message.reply_text)("❓ An unexpected error occurred while processing your image. Please try again.", reply_markup=get_main_keyboard())
+            logger.error("Photo worker failed on update %s: %s", update.update_id, e, exc_info=True)
         finally:
-            # Always cancel the chat action task in the finally block
-            chat_action_task.cancel()
-            try:
-                await chat_action_task # Await to ensure the cancellation is processed
-            except CancelledError:
-                pass # Expected if task was cancelled
-
-            context.user_data[STATE_WAITING_FOR_IMAGE] = False 
-            logger.info(f"User {user_id} state reset from WAITING_FOR_IMAGE.")
-    else:
-        logger.info(f"User {user_id} sent a photo but was NOT in WAITING_FOR_IMAGE state.")
-        await message.reply_text(
-            f"Please tap the '{BTN_REMOVE_BACKGROUND}' button first before sending an image.",
-            reply_markup=get_main_keyboard()
-        )
+            photo_jobs.pop(worker, None)
+            queue.task_done()
 
 async def handle_other_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if context.user_data.get(STATE_WAITING_FOR_IMAGE) is True:
-        logger.info(f"User {user_id} sent non-photo while in WAITING_FOR_IMAGE state: {update.message.text or 'Non-text message'}")
+        logger.info("User %d sent non-photo while in WAITING_FOR_IMAGE state: %s", user_id, update.message.text or 'Non-text message')
         await update.message.reply_text(
             "I'm waiting for an image. Please send a photo to proceed, or send /start to reset.",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
     else:
-        logger.info(f"User {user_id} sent unhandled message: {update.message.text or 'Non-text message'}")
+        logger.info("User %d sent unhandled message: %s", user_id, update.message.text or 'Non-text message')
+        reset_user_state(context, user_id)
         await update.message.reply_text(
             f"I'm a background removal bot. Please tap '{BTN_REMOVE_BACKGROUND}' to start or send /help.",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    logger.error(f"Update {update} caused error {context.error}", exc_info=context.error)
+    logger.error("Update %s caused error %s", update, context.error, exc_info=context.error)
     # Attempt to clear the state for the user if an error occurs
     if update and hasattr(update, 'effective_user') and update.effective_user:
-        context.user_data.pop(STATE_WAITING_FOR_IMAGE, None)
-        logger.info(f"Cleared WAITING_FOR_IMAGE state for user {update.effective_user.id if hasattr(update.effective_user, 'id') else 'UnknownUser'} due to error.")
+        reset_user_state(context, update.effective_user.id)
+        logger.info("Cleared WAITING_FOR_IMAGE state for user %s due to error.", update.effective_user.id if hasattr(update.effective_user, 'id') else 'UnknownUser')
     
     # Try to send an error message back to the user
     if update and hasattr(update, 'message') and update.message:
         try:
-            await update.message.reply_text("Oops! Something went wrong. My circuits are a bit tangled. Please try /start again.", reply_markup=get_main_keyboard())
+            await update.message.reply_text("Oops! Something went wrong. My circuits are a bit tangled. Please try /start again.", reply_markup=MAIN_KEYBOARD)
         except Exception as e_reply:
-            logger.error(f"Failed to send error message to user: {e_reply}")
+            logger.error("Failed to send error message to user: %s", e_reply)
+
+# --- Application Lifecycle Hooks ---
+async def post_init(application) -> None:
+    # The remove.bg session, queue and workers must be created inside the running event loop
+    await removebg.open_session()
+    photo_queue = asyncio.Queue(maxsize=PHOTO_QUEUE_SIZE)
+    application.bot_data['photo_queue'] = photo_queue
+    application.bot_data['progress_edits'] = set()
+    photo_jobs = application.bot_data['photo_jobs'] = {}
+    application.bot_data['photo_workers'] = [asyncio.create_task(photo_worker(photo_queue, photo_jobs)) for _ in range(PHOTO_WORKERS)]
+
+async def post_stop(application) -> None:
+    # Runs before Application.shutdown() closes the bot's HTTP client, so workers can still reply to their users
+    photo_queue = application.bot_data['photo_queue']
+    try:
+        await asyncio.wait_for(photo_queue.join(), timeout=PHOTO_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(
+            "Photo queue not drained within %ss, cancelling %d in-progress and %d queued photos.",
+            PHOTO_DRAIN_TIMEOUT, len(application.bot_data['photo_jobs']), photo_queue.qsize()
+        )
+    # Taken before cancelling, as each worker clears its own entry on the way out
+    interrupted = list(application.bot_data['photo_jobs'].values())
+    for worker in application.bot_data['photo_workers']:
+        worker.cancel()
+    await asyncio.gather(*application.bot_data['photo_workers'], return_exceptions=True)
+    # Photos cut off mid-processing or that never reached a worker are turned away rather than dropped silently
+    while not photo_queue.empty():
+        update, _, progress_msg = photo_queue.get_nowait()
+        interrupted.append((update, progress_msg))
+    for update, progress_msg in interrupted:
+        await report_to_user(
+            update.message, progress_msg,
+            "I'm restarting and couldn't process your image. Please send it again in a moment.",
+            update.effective_user.id
+        )
+    # Let the last "completed" edits land while the bot can still send them
+    progress_edits = application.bot_data['progress_edits']
+    if progress_edits:
+        _, pending = await asyncio.wait(list(progress_edits), timeout=MAX_EDIT_WAIT)
+        for edit_task in pending:
+            edit_task.cancel()
+
+async def post_shutdown(application) -> None:
+    await removebg.close_session()
 
 # --- Main Bot Logic ---
 def main():
@@ -269,21 +553,48 @@ def main():
     # Check for pytz (optional, but good for dependency awareness)
     try:
         import pytz 
-        logger.info(f"Successfully imported pytz version: {pytz.__version__}")
+        logger.info("Successfully imported pytz version: %s", pytz.__version__)
     except ImportError:
         logger.warning("pytz library not found. This might cause issues if used by dependencies.")
     except Exception as e:
-        logger.error(f"Could not import or check pytz version: {e}")
-
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+        logger.error("Could not import or check pytz version: %s", e)
+    # Use uvloop's faster event loop when it's available (it isn't on Windows)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("Using uvloop version: %s", uvloop.__version__)
+    except ImportError:
+        logger.info("uvloop not installed, using the default asyncio event loop.")
+
+    # HTTP/2 multiplexes the many small Bot API calls (edits, chat actions, uploads) over one connection;
+    # ApplicationBuilder already defaults to a 256-connection pool for them
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .http_version('2')
+        .connect_timeout(10)
+        .read_timeout(30)
+        # Throttles every outbound Bot API call to Telegram's documented 30 msg/s (and per-group) limits,
+        # queueing bursts instead of letting them fail with 429s
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    # Least-recently-used entries are evicted once the limit is reached
+    application.bot_data['image_hashes'] = LRUCache(maxsize=IMAGE_HASH_CACHE_SIZE)
+    application.bot_data['result_file_ids'] = LRUCache(maxsize=RESULT_FILE_ID_CACHE_SIZE)
+    # Sized by total bytes rather than entry count
+    application.bot_data['result_bytes'] = LRUCache(maxsize=RESULT_MEMORY_CACHE_BYTES, getsizeof=len)
 
     # Handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(MessageHandler(filters.TEXT & filters.Regex(f'^{BTN_REMOVE_BACKGROUND}$'), handle_remove_bg_button_press))
+    application.add_handler(MessageHandler(REMOVE_BG_BUTTON_FILTER, handle_remove_bg_button_press))
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_other_messages))
-    application.add_handler(MessageHandler(~filters.TEXT & ~filters.PHOTO & ~filters.COMMAND, handle_other_messages))
+    application.add_handler(MessageHandler(OTHER_TEXT_FILTER, handle_other_messages))
+    application.add_handler(MessageHandler(OTHER_MESSAGE_FILTER, handle_other_messages))
     
     # Error Handler
     application.add_error_handler(error_handler)
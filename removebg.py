@@ -0,0 +1,90 @@
+import asyncio
+import json
+import logging
+import os
+
+import aiohttp
+
+# --- Configuration ---
+REMOVE_BG_API_KEY = os.environ.get("REMOVE_BG_API_KEY")
+if not REMOVE_BG_API_KEY:
+    raise ValueError("REMOVE_BG_API_KEY environment variable not set. Please set it.")
+
+REMOVE_BG_API_URL = "https://api.remove.bg/v1.0/removebg"
+# remove.bg's 'preview' output is capped at 0.25 megapixels; images no bigger than that lose nothing by using it
+PREVIEW_MAX_PIXELS = 250_000
+
+# --- Shared HTTP Session ---
+# The single pooled aiohttp session for every remove.bg call in the process, so keep-alive connections
+# are reused instead of paying a fresh TCP + TLS handshake per image. It has to be created inside the
+# running event loop, so the bot opens it from its post_init hook and closes it on shutdown.
+_session = None
+# Caps simultaneous remove.bg calls to stay under its rate limit and bound the images held in memory
+REMOVE_BG_MAX_CONCURRENCY = 8
+REMOVE_BG_SEMAPHORE = asyncio.Semaphore(REMOVE_BG_MAX_CONCURRENCY)
+
+logger = logging.getLogger(__name__)
+
+
+async def open_session():
+    """Creates the shared session; call once the event loop is running."""
+    global _session
+    _session = aiohttp.ClientSession(
+        # Keep idle connections and the resolved address around between uploads
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=75),
+        timeout=aiohttp.ClientTimeout(total=45),
+        headers={'X-Api-Key': REMOVE_BG_API_KEY},
+    )
+
+async def close_session():
+    """Closes the shared session and its pooled connections."""
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+def output_size_for(width: int, height: int) -> str:
+    """Picks the cheapest remove.bg output size that keeps the image's full resolution."""
+    return 'preview' if width * height <= PREVIEW_MAX_PIXELS else 'auto'
+
+
+def _describe_error(body: bytes, content_type: str) -> str:
+    """Pulls the title/detail out of a remove.bg error body, falling back to the start of the raw body."""
+    # Only JSON bodies are parsed; anything else (e.g. a proxy's HTML page) just has its first 200 bytes decoded
+    if 'application/json' in content_type.lower():
+        try:
+            errors = json.loads(body).get('errors', [])
+            if errors and isinstance(errors, list) and 'title' in errors[0]:
+                description = errors[0]['title']
+                if 'detail' in errors[0]: description += f" - {errors[0]['detail']}"
+                return description
+        except (ValueError, AttributeError):
+            pass
+    return body[:200].decode('utf-8', errors='replace')
+
+
+async def remove_background(image_bytes, filename: str, size: str = 'auto'):
+    """Sends an image to remove.bg and returns the processed image bytes and their Content-Type.
+
+    Raises aiohttp.ClientResponseError for 4xx/5xx responses, with remove.bg's error text as its message.
+    """
+    form = aiohttp.FormData()
+    form.add_field('image_file', image_bytes, filename=filename, content_type='image/jpeg') # Sent as-is, not copied
+    form.add_field('format', 'png')
+    form.add_field('size', size)
+    logger.info("Sending image %s to remove.bg API with size=%s.", filename, size)
+
+    # Excess callers queue here instead of all hitting remove.bg (and holding their images) at once
+    async with REMOVE_BG_SEMAPHORE:
+        async with _session.post(REMOVE_BG_API_URL, data=form) as response:
+            processed_image_bytes = await response.read()
+            if response.status >= 400:
+                raise aiohttp.ClientResponseError(
+                    response.request_info,
+                    response.history,
+                    status=response.status,
+                    message=_describe_error(processed_image_bytes, response.headers.get('Content-Type', '')),
+                    headers=response.headers,
+                )
+            return processed_image_bytes, response.headers.get('Content-Type', '').lower()